@@ -5,37 +5,85 @@ Receives messages from BetterDiscord plugin and forwards to Discord channels
 Includes EarthMC town/nation monitoring
 """
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import JSONProvider
+from hypercorn.asyncio import serve
+from hypercorn.config import Config as HypercornConfig
 import discord
+import aiohttp
 import logging
 import sys
+import queue
+import atexit
 import asyncio
-from threading import Thread
+import hashlib
+import hmac
+import orjson
+from logging.handlers import QueueHandler, QueueListener
 from config import Config
 from message_handler import MessageHandler
 from webhook_manager import WebhookManager
 from earthmc_monitor import EarthMCMonitor
 
 # Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('relay_bot.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# Records are queued and written to the file and stdout by a background listener thread
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.FileHandler('relay_bot.log'),
+    logging.StreamHandler(sys.stdout)
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+log_queue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)], format='%(message)s')
+log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 logger = logging.getLogger(__name__)
 
+# >>notify notification types mapped to (category, template key)
+NOTIFY_COMMANDS = {
+    f'{category}_{action}': (category, action)
+    for category in ('town', 'nation')
+    for action in ('created', 'removed', 'renamed')
+}
+
+NOTIFY_HELP_TEXT = (
+    "**>>notify command usage:**\n"
+    "```\n"
+    ">>notify town_created <name> <leader>\n"
+    ">>notify town_removed <name>\n"
+    ">>notify town_renamed <old_name> <new_name>\n"
+    ">>notify nation_created <name> <leader>\n"
+    ">>notify nation_removed <name>\n"
+    ">>notify nation_renamed <old_name> <new_name>\n"
+    "```\n"
+    "**Examples:**\n"
+    "`>>notify town_created TestTown PlayerName`\n"
+    "`>>notify nation_renamed OldNation NewNation`"
+)
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider using orjson for request parsing and responses"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Global variables
-app = Flask(__name__)
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
 config = Config()
 bot_client = None
 webhook_manager = None
 message_handler = None
 earthmc_monitor = None
+http_session = None
+bot_ready_event = asyncio.Event()
 
 class RelayBotClient(discord.Client):
     """Discord bot client for managing webhooks"""
@@ -43,12 +91,17 @@ class RelayBotClient(discord.Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.ready = False
+        self.user_str = ''
+        self.guild_count = 0
     
     async def on_ready(self):
         """Called when bot is ready"""
-        logger.info(f'Discord bot logged in as {self.user} (ID: {self.user.id})')
-        logger.info(f'Connected to {len(self.guilds)} guilds')
+        self.user_str = str(self.user)
+        self.guild_count = len(self.guilds)
+        logger.info(f'Discord bot logged in as {self.user_str} (ID: {self.user.id})')
+        logger.info(f'Connected to {self.guild_count} guilds')
         self.ready = True
+        bot_ready_event.set()
         
         # Start EarthMC monitor if enabled
         global earthmc_monitor
@@ -56,22 +109,50 @@ class RelayBotClient(discord.Client):
             await earthmc_monitor.start()
             logger.info("EarthMC monitoring started")
     
+    async def on_guild_join(self, guild):
+        """Track guild count when the bot joins a guild"""
+        self.guild_count += 1
+    
+    async def on_guild_remove(self, guild):
+        """Track guild count when the bot leaves a guild"""
+        self.guild_count -= 1
+        
+        # Stop relaying into the guild's channels through cached channels or webhooks
+        if message_handler:
+            message_handler.destinations.clear()
+        if webhook_manager:
+            for channel in guild.channels:
+                webhook_manager.webhooks.pop(channel.id, None)
+    
+    async def on_guild_channel_delete(self, channel):
+        """Drop cached destinations and webhook of a deleted channel"""
+        if message_handler:
+            message_handler.destinations.clear()
+        if webhook_manager:
+            webhook_manager.webhooks.pop(channel.id, None)
+    
+    async def on_guild_channel_update(self, before, after):
+        """Re-resolve destinations when a channel changes (e.g. its type)"""
+        if message_handler:
+            message_handler.destinations.clear()
+    
     async def on_error(self, event, *args, **kwargs):
         """Handle errors"""
         logger.error(f'Discord error in {event}', exc_info=True)
     
     async def on_message(self, message):
         """Handle incoming messages for commands"""
-        # Ignore messages from the bot itself
-        if message.author.bot:
+        # Check for command prefix
+        content = message.content
+        if content[:2] != '>>':
             return
         
-        # Check for command prefix
-        if not message.content.startswith('>>'):
+        # Ignore messages from the bot itself
+        if message.author.bot:
             return
         
-        # Parse command
-        parts = message.content[2:].strip().split(maxsplit=1)
+        # Parse command (split() already skips surrounding whitespace)
+        parts = content[2:].split(maxsplit=1)
         if not parts:
             return
         
@@ -98,21 +179,7 @@ class RelayBotClient(discord.Client):
         
         # Parse arguments
         if not args:
-            help_text = (
-                "**>>notify command usage:**\n"
-                "```\n"
-                ">>notify town_created <name> <leader>\n"
-                ">>notify town_removed <name>\n"
-                ">>notify town_renamed <old_name> <new_name>\n"
-                ">>notify nation_created <name> <leader>\n"
-                ">>notify nation_removed <name>\n"
-                ">>notify nation_renamed <old_name> <new_name>\n"
-                "```\n"
-                "**Examples:**\n"
-                "`>>notify town_created TestTown PlayerName`\n"
-                "`>>notify nation_renamed OldNation NewNation`"
-            )
-            await message.channel.send(help_text)
+            await message.channel.send(NOTIFY_HELP_TEXT)
             return
         
         parts = args.split(maxsplit=2)
@@ -122,19 +189,13 @@ class RelayBotClient(discord.Client):
         
         notification_type = parts[0].lower()
         
-        # Define valid notification types
-        valid_types = {
-            'town_created', 'town_removed', 'town_renamed',
-            'nation_created', 'nation_removed', 'nation_renamed'
-        }
-        
-        if notification_type not in valid_types:
-            await message.channel.send(f"[**I**] Notification type not recognized. Valid types: `{', '.join(valid_types)}`")
+        # Look up the town/nation category and template key
+        entry = NOTIFY_COMMANDS.get(notification_type)
+        if entry is None:
+            await message.channel.send(f"[**I**] Notification type not recognized. Valid types: `{', '.join(NOTIFY_COMMANDS)}`")
             return
         
-        # Determine if it's a town or nation
-        notif_category = 'town' if 'town' in notification_type else 'nation'
-        template_key = notification_type.replace('town_', '').replace('nation_', '')
+        notif_category, template_key = entry
         
         # Get the template
         templates = config.get_notification_templates(notif_category)
@@ -174,8 +235,8 @@ class RelayBotClient(discord.Client):
                 await message.channel.send(f"❌ Unknown template key: {template_key}")
                 return
             
-            # Generate the image
-            image = earthmc_monitor.generate_minecraft_image(notification_message, notif_category)
+            # Generate the image off the event loop
+            image = await asyncio.to_thread(earthmc_monitor.generate_minecraft_image, notification_message, notif_category)
             
             # Send the image to the channel
             file = discord.File(image, filename=f'{notification_type}_test.png')
@@ -189,9 +250,9 @@ class RelayBotClient(discord.Client):
             await message.channel.send(f"[**E**] Error generating notification: {e}")
             logger.error(f"Error in notify command: {e}", exc_info=True)
 
-def run_discord_bot():
-    """Run the Discord bot in a separate thread"""
-    global bot_client, webhook_manager, message_handler, earthmc_monitor
+def setup_discord_bot():
+    """Create the Discord bot client and its helpers"""
+    global bot_client, webhook_manager, message_handler, earthmc_monitor, http_session
     
     # Set up Discord bot
     intents = discord.Intents.default()
@@ -206,28 +267,45 @@ def run_discord_bot():
     # Set up message handler
     message_handler = MessageHandler(config, webhook_manager, bot_client)
     
-    # Set up EarthMC monitor
-    earthmc_monitor = EarthMCMonitor(bot_client, config, webhook_manager)
+    # Shared HTTP session for outbound API calls, reusing connections and DNS lookups
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=10, ttl_dns_cache=300)
+    )
     
-    # Run the bot
+    # Set up EarthMC monitor
+    earthmc_monitor = EarthMCMonitor(bot_client, config, webhook_manager, session=http_session)
+
+async def run_discord_bot():
+    """Run the Discord bot on the shared event loop"""
     try:
-        bot_client.run(config.bot_token)
+        await bot_client.start(config.bot_token)
     except Exception as e:
         logger.error(f"Error running Discord bot: {e}")
-        sys.exit(1)
+        raise
+
+def _check_auth(req) -> bool:
+    """Compare the request's Authorization header to the auth token in constant time"""
+    auth_header = req.headers.get('Authorization', '')
+    auth_digest = hashlib.sha256(auth_header.encode()).digest()
+    return hmac.compare_digest(auth_digest, config.auth_token_digest)
+
+# Home endpoint bodies, which only differ by bot readiness
+HOME_INFO = {
+    'status': 'running',
+    'service': 'Discord Message Relay Bot',
+    'version': '1.0.0'
+}
+HOME_BODY_READY = orjson.dumps({**HOME_INFO, 'bot_ready': True})
+HOME_BODY_NOT_READY = orjson.dumps({**HOME_INFO, 'bot_ready': False})
 
 @app.route('/')
-def home():
+async def home():
     """Home endpoint"""
-    return jsonify({
-        'status': 'running',
-        'service': 'Discord Message Relay Bot',
-        'version': '1.0.0',
-        'bot_ready': bot_client.ready if bot_client else False
-    })
+    body = HOME_BODY_READY if bot_client and bot_client.ready else HOME_BODY_NOT_READY
+    return Response(body, mimetype='application/json')
 
 @app.route('/health', methods=['GET'])
-def health():
+async def health():
     """Health check endpoint"""
     try:
         if not bot_client or not bot_client.ready:
@@ -237,18 +315,15 @@ def health():
             }), 503
         
         relay_groups_count = len(config.relay_groups)
-        total_destinations = sum(
-            len(group.get('destination_channels', [])) 
-            for group in config.relay_groups.values()
-        )
         
         response = {
             'status': 'healthy',
             'bot_ready': True,
-            'bot_user': str(bot_client.user),
-            'guilds': len(bot_client.guilds),
+            'bot_user': bot_client.user_str,
+            'guilds': bot_client.guild_count,
             'relay_groups': relay_groups_count,
-            'total_destinations': total_destinations,
+            'total_destinations': config.total_destinations,
+            'relay_failures': message_handler.failed_count,
             'earthmc': {
                 'enabled': config.earthmc_enabled,
                 'monitoring': earthmc_monitor is not None and earthmc_monitor.monitor_task is not None
@@ -261,72 +336,54 @@ def health():
         
         return jsonify(response), 200
     except Exception as e:
-        logger.error(f"Health check error: {e}")
+        logger.error("Health check error: %s", e)
         return jsonify({
             'status': 'error',
             'error': str(e)
         }), 500
 
-@app.route('/relay', methods=['POST'])
-def relay():
-    """
-    Direct relay endpoint for BetterDiscord plugin
-    Receives messages directly from the plugin without intermediate relay server
-    """
+def queue_relay(data):
+    """Queue a message for relaying and build the 202 response"""
     try:
-        # Check if bot is ready
-        if not bot_client or not bot_client.ready:
-            return jsonify({
-                'error': 'Bot not ready',
-                'status': 'starting'
-            }), 503
-        
-        # Validate authorization
-        auth_header = request.headers.get('Authorization', '')
-        if config.auth_token and auth_header != config.auth_token:
-            logger.warning(f"Unauthorized relay request from {request.remote_addr}")
-            return jsonify({'error': 'Unauthorized'}), 401
-        
-        # Get message data
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-        
-        logger.info(f"Received relay message from channel {data.get('channel_id')}")
-        
-        # Process the message asynchronously
-        future = asyncio.run_coroutine_threadsafe(
+        queued, error_msg = message_handler.enqueue_message(data)
+    except asyncio.QueueFull:
+        logger.warning("Relay queue full, dropping message from channel %s", data.get('channel_id'))
+        return jsonify({
+            'error': 'Relay queue full',
+            'status': 'busy'
+        }), 503
+    
+    if queued:
+        return jsonify({'status': 'queued'}), 202
+    else:
+        return jsonify({
+            'status': 'partial_success',
+            'message': error_msg
+        }), 200
+
+async def relay_and_wait(data):
+    """Relay a message and build the response from its result"""
+    try:
+        success, error_msg = await asyncio.wait_for(
             message_handler.process_message(data),
-            bot_client.loop
+            timeout=30
         )
         
-        # Wait for result with timeout
-        try:
-            success, error_msg = future.result(timeout=30)
-            
-            if success:
-                return jsonify({'status': 'success'}), 200
-            else:
-                return jsonify({
-                    'status': 'partial_success',
-                    'message': error_msg
-                }), 200
-        except TimeoutError:
+        if success:
+            return jsonify({'status': 'success'}), 200
+        else:
             return jsonify({
-                'error': 'Processing timeout',
-                'status': 'timeout'
-            }), 504
-            
-    except Exception as e:
-        logger.error(f"Error processing relay: {e}", exc_info=True)
-        return jsonify({'error': str(e)}), 500
+                'status': 'partial_success',
+                'message': error_msg
+            }), 200
+    except TimeoutError:
+        return jsonify({
+            'error': 'Processing timeout',
+            'status': 'timeout'
+        }), 504
 
-@app.route('/message', methods=['POST'])
-def receive_message():
-    """
-    Receive and process message from relay server (legacy endpoint)
-    Kept for backward compatibility if using intermediate relay
-    """
+async def handle_relay_request(kind):
+    """Shared implementation of the /relay and /message endpoints"""
     try:
         # Check if bot is ready
         if not bot_client or not bot_client.ready:
@@ -336,51 +393,62 @@ def receive_message():
             }), 503
         
         # Validate authorization
-        auth_header = request.headers.get('Authorization', '')
-        if config.auth_token and auth_header != config.auth_token:
-            logger.warning(f"Unauthorized request from {request.remote_addr}")
+        if config.auth_token and not _check_auth(request):
+            logger.warning("Unauthorized %s request from %s", kind, request.remote_addr)
             return jsonify({'error': 'Unauthorized'}), 401
         
         # Get message data
-        data = request.get_json()
+        if not request.headers.get('Content-Type', '').startswith('application/json'):
+            return jsonify({'error': 'Content-Type must be application/json'}), 415
+        
+        raw = await request.get_data(cache=False)
+        if not raw:
+            return jsonify({'error': 'No data provided'}), 400
+        
+        try:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return jsonify({'error': 'Invalid JSON'}), 400
         if not data:
             return jsonify({'error': 'No data provided'}), 400
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Message must be a JSON object'}), 400
         
-        logger.info(f"Received message from channel {data.get('channel_id')}")
+        # IDs are handled as strings from here on
+        message_handler.normalize_ids(data)
         
-        # Process the message asynchronously
-        future = asyncio.run_coroutine_threadsafe(
-            message_handler.process_message(data),
-            bot_client.loop
-        )
+        logger.info("Received %s message from channel %s", kind, data.get('channel_id'))
         
-        # Wait for result with timeout
-        try:
-            success, error_msg = future.result(timeout=30)
-            
-            if success:
-                return jsonify({'status': 'success'}), 200
-            else:
-                return jsonify({
-                    'status': 'partial_success',
-                    'message': error_msg
-                }), 200
-        except TimeoutError:
-            return jsonify({
-                'error': 'Processing timeout',
-                'status': 'timeout'
-            }), 504
+        # Callers can pass ?wait=1 to get the relay result instead of a 202
+        if request.args.get('wait') == '1':
+            return await relay_and_wait(data)
+        return queue_relay(data)
             
     except Exception as e:
-        logger.error(f"Error processing message: {e}", exc_info=True)
+        logger.error("Error processing %s: %s", kind, e, exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/relay', methods=['POST'])
+async def relay():
+    """
+    Direct relay endpoint for BetterDiscord plugin
+    Receives messages directly from the plugin without intermediate relay server
+    """
+    return await handle_relay_request('relay')
+
+@app.route('/message', methods=['POST'])
+async def receive_message():
+    """
+    Receive and process message from relay server (legacy endpoint)
+    Kept for backward compatibility if using intermediate relay
+    """
+    return await handle_relay_request('message')
+
 @app.route('/reload-config', methods=['POST'])
-def reload_config():
+async def reload_config():
     """Reload configuration (requires auth)"""
     try:
-        auth_header = request.headers.get('Authorization', '')
-        if config.auth_token and auth_header != config.auth_token:
+        if config.auth_token and not _check_auth(request):
             return jsonify({'error': 'Unauthorized'}), 401
         
         config.load_config()
@@ -388,16 +456,11 @@ def reload_config():
         
         # Restart EarthMC monitor if config changed
         if earthmc_monitor:
-            asyncio.run_coroutine_threadsafe(
-                earthmc_monitor.stop(),
-                bot_client.loop
-            )
+            earthmc_monitor.clear_image_cache()
+            await earthmc_monitor.stop()
             
             if config.earthmc_enabled:
-                asyncio.run_coroutine_threadsafe(
-                    earthmc_monitor.start(),
-                    bot_client.loop
-                )
+                await earthmc_monitor.start()
                 logger.info("EarthMC monitor restarted with new config")
         
         return jsonify({'status': 'success', 'message': 'Configuration reloaded'}), 200
@@ -407,7 +470,7 @@ def reload_config():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/earthmc/status', methods=['GET'])
-def earthmc_status():
+async def earthmc_status():
     """Get EarthMC monitoring status"""
     try:
         if not config.earthmc_enabled:
@@ -438,11 +501,10 @@ def earthmc_status():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/earthmc/force-check', methods=['POST'])
-def earthmc_force_check():
+async def earthmc_force_check():
     """Force an immediate EarthMC API check (requires auth)"""
     try:
-        auth_header = request.headers.get('Authorization', '')
-        if config.auth_token and auth_header != config.auth_token:
+        if config.auth_token and not _check_auth(request):
             return jsonify({'error': 'Unauthorized'}), 401
         
         if not config.earthmc_enabled:
@@ -457,15 +519,11 @@ def earthmc_force_check():
         
         # Cancel current task and restart it
         earthmc_monitor.monitor_task.cancel()
-        
-        async def restart():
-            try:
-                await earthmc_monitor.monitor_task
-            except asyncio.CancelledError:
-                pass
-            earthmc_monitor.monitor_task = asyncio.create_task(earthmc_monitor._monitor_loop())
-        
-        asyncio.run_coroutine_threadsafe(restart(), bot_client.loop)
+        try:
+            await earthmc_monitor.monitor_task
+        except asyncio.CancelledError:
+            pass
+        earthmc_monitor.monitor_task = asyncio.create_task(earthmc_monitor._monitor_loop())
         
         logger.info("EarthMC force check triggered")
         return jsonify({
@@ -477,6 +535,44 @@ def earthmc_force_check():
         logger.error(f"Error forcing EarthMC check: {e}")
         return jsonify({'error': str(e)}), 500
 
+async def main():
+    """Run the Discord bot and the Quart server on a single event loop"""
+    setup_discord_bot()
+    
+    # Start Discord bot as a task alongside the web server
+    logger.info("Starting Discord bot...")
+    bot_task = asyncio.create_task(run_discord_bot())
+    
+    try:
+        # Wait for the bot to be ready (or to fail) before accepting requests
+        ready_task = asyncio.create_task(bot_ready_event.wait())
+        await asyncio.wait({bot_task, ready_task}, timeout=30, return_when=asyncio.FIRST_COMPLETED)
+        ready_task.cancel()
+        
+        if not bot_ready_event.is_set():
+            logger.error("Discord bot did not become ready")
+        else:
+            # Start Quart server
+            port = config.port
+            hypercorn_config = HypercornConfig()
+            hypercorn_config.bind = [f"0.0.0.0:{port}"]
+            logger.info(f"Starting Quart server on port {port}")
+            logger.info(f"Direct relay endpoint available at: http://0.0.0.0:{port}/relay")
+            
+            # Stop serving as soon as the bot stops
+            await serve(app, hypercorn_config, shutdown_trigger=lambda: asyncio.wait({bot_task}))
+    finally:
+        if earthmc_monitor:
+            await earthmc_monitor.stop()
+        await http_session.close()
+        if not bot_client.is_closed():
+            await bot_client.close()
+        await asyncio.wait({bot_task})
+    
+    bot_failed = not bot_task.cancelled() and bot_task.exception() is not None
+    if bot_failed or not bot_ready_event.is_set():
+        sys.exit(1)
+
 if __name__ == '__main__':
     logger.info("Starting Discord Message Relay Bot")
     
@@ -488,18 +584,4 @@ if __name__ == '__main__':
     logger.info(f"Configured relay groups: {len(config.relay_groups)}")
     logger.info(f"EarthMC monitoring: {'enabled' if config.earthmc_enabled else 'disabled'}")
     
-    # Start Discord bot in separate thread
-    logger.info("Starting Discord bot...")
-    bot_thread = Thread(target=run_discord_bot, daemon=True)
-    bot_thread.start()
-    
-    # Wait a moment for bot to initialize
-    import time
-    time.sleep(3)
-    
-    # Start Flask server
-    port = config.port
-    logger.info(f"Starting Flask server on port {port}")
-    logger.info(f"Direct relay endpoint available at: http://0.0.0.0:{port}/relay")
-    
-    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
\ No newline at end of file
+    asyncio.run(main())
@@ -1,7 +1,10 @@
 import json
+import orjson
+import hashlib
 import logging
 import os
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Callable, Tuple
+from utils import darken_color, compile_template
 
 logger = logging.getLogger(__name__)
 
@@ -17,8 +20,8 @@ class Config:
         """Load configuration from file"""
         try:
             if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    self.data = json.load(f)
+                with open(self.config_file, 'rb') as f:
+                    self.data = orjson.loads(f.read())
                 logger.info(f"Configuration loaded from {self.config_file}")
             else:
                 logger.warning("No config file found, creating default configuration")
@@ -27,6 +30,93 @@ class Config:
         except Exception as e:
             logger.error(f"Error loading config: {e}")
             self.create_default_config()
+        
+        self.build_indexes()
+    
+    def build_indexes(self):
+        """Precompute lookups derived from the configuration data"""
+        # Everything is built into locals and assigned at the end, so a failure
+        # never leaves a mix of old and new indexes in place
+        auth_token_digest = hashlib.sha256((self.auth_token or '').encode()).digest()
+        
+        admin_users = set()
+        for user_id in self.data.get("admin_users", []):
+            if not user_id:
+                continue
+            try:
+                admin_users.add(int(user_id))
+            except (TypeError, ValueError):
+                logger.warning(f"Invalid admin user ID: {user_id}")
+        
+        earthmc = self.data.get("earthmc", {})
+        notifications = earthmc.get("notifications", {})
+        
+        # Notification templates parsed once, keyed by type then event
+        template_fns: Dict[str, Dict[str, Callable[..., str]]] = {
+            notif_type: {
+                event: compile_template(template)
+                for event, template in notif_config.get("templates", {}).items()
+            }
+            for notif_type, notif_config in notifications.items()
+        }
+        
+        # Text shadow color for each Minecraft color
+        shadow_colors: Dict[str, str] = {}
+        for hex_color in earthmc.get("minecraft_colors", {}).values():
+            try:
+                shadow_colors[hex_color] = darken_color(hex_color, factor=0.25)
+            except ValueError:
+                logger.warning(f"Invalid Minecraft color: {hex_color}")
+        relay_groups = self.data.get("relay_groups", {})
+        
+        # Reverse index of source channel -> relay group and channel info (first group wins)
+        channel_to_group: Dict[str, str] = {}
+        channel_info: Dict[str, Dict[str, Any]] = {}
+        destination_ids: Dict[str, List[int]] = {}
+        notif_groups: Dict[str, List[str]] = {"town": [], "nation": []}
+        total_destinations = 0
+        
+        for group_name, group_config in relay_groups.items():
+            for channel_id, source_info in group_config.get("source_channels", {}).items():
+                channel_to_group.setdefault(channel_id, group_name)
+                channel_info.setdefault(channel_id, source_info)
+            
+            for notif_type, groups in notif_groups.items():
+                if group_config.get(f"earthmc_{notif_type}s", False):  # 'earthmc_towns' or 'earthmc_nations'
+                    groups.append(group_name)
+            
+            dest_channels = group_config.get("destination_channels", [])
+            total_destinations += len(dest_channels)
+            
+            # Destination IDs are stored as strings, converted once here
+            destination_ids[group_name] = []
+            for ch_id in dest_channels:
+                if not ch_id:
+                    continue
+                try:
+                    destination_ids[group_name].append(int(ch_id))
+                except (TypeError, ValueError):
+                    logger.warning(f"Invalid destination channel ID in {group_name}: {ch_id}")
+        
+        # Everything needed to relay a message from a source channel: (group, source info, destinations)
+        routes: Dict[str, Tuple[str, Dict[str, Any], List[int]]] = {
+            channel_id: (group_name, channel_info[channel_id], destination_ids[group_name])
+            for channel_id, group_name in channel_to_group.items()
+        }
+        
+        self.auth_token_digest = auth_token_digest
+        self._admin_users = frozenset(admin_users)
+        self._earthmc = earthmc
+        self._notifications = notifications
+        self._template_fns = template_fns
+        self._shadow_colors = shadow_colors
+        self._relay_groups = relay_groups
+        self._channel_to_group = channel_to_group
+        self._channel_info = channel_info
+        self._destination_ids = destination_ids
+        self._notif_groups = notif_groups
+        self._total_destinations = total_destinations
+        self._routes = routes
     
     def create_default_config(self):
         """Create default configuration"""
@@ -94,9 +184,22 @@ class Config:
     
     def save_config(self):
         """Save configuration to file"""
+        self.build_indexes()
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, indent=4, ensure_ascii=False)
+            new_data = json.dumps(self.data, indent=4, ensure_ascii=False).encode('utf-8')
+            
+            # Skip the write if the file already holds this configuration
+            if os.path.exists(self.config_file):
+                with open(self.config_file, 'rb') as f:
+                    if f.read() == new_data:
+                        logger.debug("Configuration unchanged, not saving")
+                        return
+            
+            # Write to a temporary file first so a crash never leaves a truncated config
+            tmp_file = f"{self.config_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(new_data)
+            os.replace(tmp_file, self.config_file)
             logger.info(f"Configuration saved to {self.config_file}")
         except Exception as e:
             logger.error(f"Error saving config: {e}")
@@ -124,76 +227,71 @@ class Config:
     @property
     def admin_users(self) -> List[int]:
         """Get list of admin user IDs"""
-        admin_list = self.data.get("admin_users", [])
-        return [int(user_id) for user_id in admin_list if user_id]
+        return list(self._admin_users)
     
     def is_admin(self, user_id: int) -> bool:
         """Check if a user ID is in the admin list"""
-        return user_id in self.admin_users
+        return user_id in self._admin_users
     
     @property
     def relay_groups(self) -> Dict[str, Dict[str, Any]]:
         """Get all relay groups"""
-        return self.data.get("relay_groups", {})
+        return self._relay_groups
+    
+    @property
+    def total_destinations(self) -> int:
+        """Get the number of destination channels across all relay groups"""
+        return self._total_destinations
     
     def get_relay_group_for_channel(self, channel_id: str) -> Optional[str]:
         """Find which relay group a source channel belongs to"""
-        for group_name, group_config in self.relay_groups.items():
-            source_channels = group_config.get("source_channels", {})
-            if channel_id in source_channels:
-                return group_name
-        return None
+        return self._channel_to_group.get(channel_id)
     
     def get_source_channel_info(self, channel_id: str) -> Optional[Dict[str, Any]]:
         """Get source channel information"""
-        for group_config in self.relay_groups.values():
-            source_channels = group_config.get("source_channels", {})
-            if channel_id in source_channels:
-                return source_channels[channel_id]
-        return None
+        return self._channel_info.get(channel_id)
     
     def get_destination_channel_ids(self, group_name: str) -> List[int]:
         """Get all destination channel IDs for a relay group"""
-        if group_name not in self.relay_groups:
-            return []
-        
-        dest_channels = self.relay_groups[group_name].get("destination_channels", [])
-        # Convert string IDs to integers
-        return [int(ch_id) for ch_id in dest_channels if ch_id]
+        return self._destination_ids.get(group_name, [])
+    
+    def get_channel_route(self, channel_id: str) -> Optional[Tuple[str, Dict[str, Any], List[int]]]:
+        """Get (relay group, source channel info, destination channel IDs) for a source channel"""
+        return self._routes.get(channel_id)
     
     # EarthMC configuration properties
     @property
     def earthmc_enabled(self) -> bool:
         """Check if EarthMC monitoring is enabled"""
-        return self.data.get("earthmc", {}).get("enabled", False)
+        return self._earthmc.get("enabled", False)
     
     @property
     def earthmc_poll_interval(self) -> int:
         """Get EarthMC polling interval in seconds"""
-        return self.data.get("earthmc", {}).get("poll_interval", 60)
+        return self._earthmc.get("poll_interval", 60)
     
     @property
     def minecraft_colors(self) -> Dict[str, str]:
         """Get Minecraft color codes"""
-        return self.data.get("earthmc", {}).get("minecraft_colors", {})
+        return self._earthmc.get("minecraft_colors", {})
+    
+    @property
+    def shadow_colors(self) -> Dict[str, str]:
+        """Get text shadow colors keyed by Minecraft color"""
+        return self._shadow_colors
     
     def get_notification_templates(self, notif_type: str) -> Dict[str, str]:
         """Get notification templates for town or nation"""
-        notifications = self.data.get("earthmc", {}).get("notifications", {})
-        return notifications.get(notif_type, {}).get("templates", {})
+        return self._notifications.get(notif_type, {}).get("templates", {})
+    
+    def get_notification_template_fns(self, notif_type: str) -> Dict[str, Callable[..., str]]:
+        """Get precompiled notification templates for town or nation"""
+        return self._template_fns.get(notif_type, {})
     
     def get_notification_crop_settings(self, notif_type: str) -> Dict[str, int]:
         """Get crop settings for notification images"""
-        notifications = self.data.get("earthmc", {}).get("notifications", {})
-        return notifications.get(notif_type, {}).get("crop", {"buffer_pixels": 0, "panel_padding": 3})
+        return self._notifications.get(notif_type, {}).get("crop", {"buffer_pixels": 0, "panel_padding": 3})
     
     def get_notification_relay_groups(self, notif_type: str) -> List[str]:
         """Get relay groups that should receive this notification type"""
-        relay_groups = []
-        key = f"earthmc_{notif_type}s"  # 'earthmc_towns' or 'earthmc_nations'
-        
-        for group_name, group_config in self.relay_groups.items():
-            if group_config.get(key, False):
-                relay_groups.append(group_name)
-        
-        return relay_groups
\ No newline at end of file
+        return self._notif_groups.get(notif_type, [])
\ No newline at end of file
@@ -6,20 +6,37 @@ Monitors EarthMC API for town/nation changes and sends notifications
 import discord
 import aiohttp
 import asyncio
-import json
+import orjson
 import logging
 from datetime import datetime
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
 import io
 import random
+import functools
+import re
+from utils import darken_color
 
 logger = logging.getLogger(__name__)
 
+# Minecraft formatting code: '§' followed by the code character
+COLOR_CODE_RE = re.compile(r'§(.)', re.DOTALL)
+
+# Request headers for JSON bodies encoded with orjson
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Image formats accepted as notification backgrounds
+BACKGROUND_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+# Maximum number of uuids per EarthMC details query
+DETAILS_BATCH_SIZE = 100
+
+# Maximum number of notification uploads in flight at once
+MAX_CONCURRENT_NOTIFICATIONS = 5
+
 class EarthMCMonitor:
     """Monitors EarthMC API for town and nation changes"""
     
-    def __init__(self, bot_client, config, webhook_manager):
+    def __init__(self, bot_client, config, webhook_manager, session=None):
         self.bot = bot_client
         self.config = config
         self.webhook_manager = webhook_manager
@@ -27,8 +44,16 @@ class EarthMCMonitor:
         # Store as dict: {uuid: name}
         self.previous_towns = {}
         self.previous_nations = {}
-        self.session = None
+        
+        # Use the shared HTTP session if one is given, otherwise create our own on start
+        self.session = session
+        self.owns_session = session is None
+        
+        # Image resources, loaded on first render
+        self.font = None
+        self.backgrounds = None
         self.monitor_task = None
+        self.send_semaphore = asyncio.Semaphore(MAX_CONCURRENT_NOTIFICATIONS)
         
         # State file
         self.state_file = Path('./tbi/data/state.json')
@@ -40,9 +65,13 @@ class EarthMCMonitor:
             logger.info("EarthMC monitoring is disabled in config")
             return
             
-        self.session = aiohttp.ClientSession()
+        if self.owns_session:
+            self.session = aiohttp.ClientSession()
         self.load_state()
         
+        # Decode the font and backgrounds up front instead of on the first notification
+        await asyncio.to_thread(self.load_image_resources)
+        
         # Start monitoring task
         self.monitor_task = asyncio.create_task(self._monitor_loop())
         logger.info("EarthMC monitor started")
@@ -56,7 +85,7 @@ class EarthMCMonitor:
             except asyncio.CancelledError:
                 pass
         
-        if self.session:
+        if self.owns_session and self.session:
             await self.session.close()
         
         logger.info("EarthMC monitor stopped")
@@ -65,8 +94,8 @@ class EarthMCMonitor:
         """Load previous state from file"""
         if self.state_file.exists():
             try:
-                with open(self.state_file, 'r') as f:
-                    data = json.load(f)
+                with open(self.state_file, 'rb') as f:
+                    data = orjson.loads(f.read())
                     
                     towns = data.get('towns', {})
                     if isinstance(towns, dict):
@@ -96,129 +125,105 @@ class EarthMCMonitor:
                 'nations': self.previous_nations,
                 'last_updated': datetime.now().isoformat()
             }
-            with open(self.state_file, 'w') as f:
-                json.dump(data, f, indent=2)
+            with open(self.state_file, 'wb') as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
         except Exception as e:
             logger.error(f"Error saving EarthMC state: {e}")
     
+    async def fetch_listing(self, url, label):
+        """Fetch a listing from the EarthMC API"""
+        async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            if resp.status == 200:
+                return orjson.loads(await resp.read())
+            logger.error(f"{label} API returned status {resp.status}")
+            return None
+    
     async def fetch_api_data(self):
-        """Fetch towns and nations from EarthMC API"""
+        """
+        Fetch towns and nations from EarthMC API concurrently
+        Returns (None, None) if either listing could not be fetched
+        """
         try:
             towns_url = 'https://api.earthmc.net/v3/aurora/towns'
             nations_url = 'https://api.earthmc.net/v3/aurora/nations'
             
-            async with self.session.get(towns_url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-                if resp.status == 200:
-                    towns = await resp.json()
-                else:
-                    logger.error(f"Towns API returned status {resp.status}")
-                    return None, None
-            
-            async with self.session.get(nations_url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-                if resp.status == 200:
-                    nations = await resp.json()
-                else:
-                    logger.error(f"Nations API returned status {resp.status}")
-                    return None, None
+            # Request both listings concurrently
+            towns, nations = await asyncio.gather(
+                self.fetch_listing(towns_url, 'Towns'),
+                self.fetch_listing(nations_url, 'Nations')
+            )
+            if towns is None or nations is None:
+                return None, None
                     
             return towns, nations
         except Exception as e:
             logger.error(f"Error fetching EarthMC API data: {e}")
             return None, None
     
-    async def fetch_town_details(self, town_name_or_uuid):
-        """Fetch detailed town information via POST request"""
-        try:
-            url = 'https://api.earthmc.net/v3/aurora/towns'
-            payload = {"query": [town_name_or_uuid]}
-            
-            async with self.session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if data and len(data) > 0:
-                        return data[0]
-                return None
-        except Exception as e:
-            logger.error(f"Error fetching town details: {e}")
-            return None
+    async def fetch_details(self, url, uuids, label):
+        """Fetch detailed information via POST requests of at most DETAILS_BATCH_SIZE uuids each"""
+        uuids = list(uuids)
+        details = {}
+        
+        for start in range(0, len(uuids), DETAILS_BATCH_SIZE):
+            payload = {"query": uuids[start:start + DETAILS_BATCH_SIZE]}
+            try:
+                async with self.session.post(url, data=orjson.dumps(payload), headers=JSON_HEADERS,
+                                             timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                    if resp.status == 200:
+                        data = orjson.loads(await resp.read())
+                        details.update((item['uuid'], item) for item in data or [])
+                    else:
+                        logger.error(f"{label} details API returned status {resp.status}")
+            except Exception as e:
+                logger.error(f"Error fetching {label.lower()} details: {e}")
+        
+        return details
     
-    async def fetch_nation_details(self, nation_name_or_uuid):
-        """Fetch detailed nation information via POST request"""
-        try:
-            url = 'https://api.earthmc.net/v3/aurora/nations'
-            payload = {"query": [nation_name_or_uuid]}
-            
-            async with self.session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if data and len(data) > 0:
-                        return data[0]
-                return None
-        except Exception as e:
-            logger.error(f"Error fetching nation details: {e}")
-            return None
+    async def fetch_towns_details(self, uuids):
+        """Fetch detailed information for several towns, keyed by uuid"""
+        return await self.fetch_details('https://api.earthmc.net/v3/aurora/towns', uuids, 'Town')
+    
+    async def fetch_nations_details(self, uuids):
+        """Fetch detailed information for several nations, keyed by uuid"""
+        return await self.fetch_details('https://api.earthmc.net/v3/aurora/nations', uuids, 'Nation')
     
     def parse_color_codes(self, text):
         """Parse Minecraft color codes and return segments with colors"""
         mc_colors = self.config.minecraft_colors
         segments = []
         current_color = '#FFFFFF'
-        current_text = ''
-        
-        i = 0
-        while i < len(text):
-            if text[i] == '§' and i + 1 < len(text):
-                if current_text:
-                    segments.append((current_text, current_color))
-                    current_text = ''
-                
-                code = text[i + 1].lower()
-                if code in mc_colors:
-                    current_color = mc_colors[code]
-                i += 2
-            else:
-                current_text += text[i]
-                i += 1
+        pos = 0
         
-        if current_text:
-            segments.append((current_text, current_color))
+        for match in COLOR_CODE_RE.finditer(text):
+            if match.start() > pos:
+                segments.append((text[pos:match.start()], current_color))
+            
+            current_color = mc_colors.get(match.group(1).lower(), current_color)
+            pos = match.end()
+        
+        if pos < len(text):
+            segments.append((text[pos:], current_color))
         
         return segments
     
     def darken_color(self, hex_color, factor=0.25):
         """Darken a hex color by a given factor"""
-        hex_color = hex_color.lstrip('#')
-        r = int(hex_color[0:2], 16)
-        g = int(hex_color[2:4], 16)
-        b = int(hex_color[4:6], 16)
-        
-        r = int(r * factor)
-        g = int(g * factor)
-        b = int(b * factor)
-        
-        return f'#{r:02x}{g:02x}{b:02x}'
+        return darken_color(hex_color, factor)
     
-    def generate_minecraft_image(self, message_text, notif_type='town'):
-        """Generate a Minecraft-style chat message image"""
+    def load_font(self):
+        """Load the Minecraft font (or a fallback) once and cache it"""
+        if self.font is not None:
+            return self.font
         
-        # Get crop settings from config
-        crop_settings = self.config.get_notification_crop_settings(notif_type)
+        from PIL import ImageFont
         
-        bg_color = '#1C1C1C'
-        text_bg_opacity = 180
-        panel_color = (0, 0, 0)
-        buffer_pixels = crop_settings.get('buffer_pixels', 0)
-        panel_padding = crop_settings.get('panel_padding', 3)
-        shadow_offset = 2
-        
-        # Load font
         font_loaded = False
         font_path = './tbi/data/minecraft.otf'
         
         if Path(font_path).exists():
             try:
                 font = ImageFont.truetype(font_path, 20)
-                shadow_font = font
                 font_loaded = True
                 logger.debug(f"Using Minecraft font: {font_path}")
             except Exception as e:
@@ -227,31 +232,86 @@ class EarthMCMonitor:
         if not font_loaded:
             try:
                 font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf', 18)
-                shadow_font = font
                 logger.debug("Using fallback font: DejaVu Sans Mono")
             except:
                 try:
                     font = ImageFont.truetype('C:/Windows/Fonts/consola.ttf', 18)
-                    shadow_font = font
                     logger.debug("Using fallback font: Consolas")
                 except:
                     font = ImageFont.load_default()
-                    shadow_font = font
                     logger.warning("Using default font (low quality)")
         
+        self.font = font
+        return font
+    
+    def load_backgrounds(self):
+        """Decode the background images once and cache them as (name, image) pairs"""
+        if self.backgrounds is None:
+            from PIL import Image
+            
+            background_dir = Path('./tbi/data/backgrounds')
+            self.backgrounds = []
+            
+            if background_dir.exists():
+                for bg_path in background_dir.iterdir():
+                    if bg_path.suffix.lower() not in BACKGROUND_EXTENSIONS:
+                        continue
+                    
+                    try:
+                        with Image.open(bg_path) as bg_image:
+                            self.backgrounds.append((bg_path.name, bg_image.convert('RGBA')))
+                    except Exception as e:
+                        logger.warning(f"Failed to load background {bg_path.name}: {e}")
+        
+        return self.backgrounds
+    
+    def load_image_resources(self):
+        """Load everything needed to render notification images"""
+        self.load_font()
+        backgrounds = self.load_backgrounds()
+        logger.info(f"Loaded {len(backgrounds)} EarthMC background images")
+    
+    def generate_minecraft_image(self, message_text, notif_type='town'):
+        """Generate a Minecraft-style chat message image"""
+        return io.BytesIO(self.render_minecraft_png(message_text, notif_type))
+    
+    def clear_image_cache(self):
+        """Drop cached notification images (e.g. after a config reload)"""
+        self.render_minecraft_png.cache_clear()
+        self.backgrounds = None
+    
+    @functools.lru_cache(maxsize=256)
+    def render_minecraft_png(self, message_text, notif_type='town'):
+        """Render a Minecraft-style chat message image to PNG bytes"""
+        
+        from PIL import Image, ImageDraw, ImageColor
+        
+        # Get crop settings from config
+        crop_settings = self.config.get_notification_crop_settings(notif_type)
+        
+        bg_color = '#1C1C1C'
+        text_bg_opacity = 180
+        panel_color = (0, 0, 0)
+        buffer_pixels = crop_settings.get('buffer_pixels', 0)
+        panel_padding = crop_settings.get('panel_padding', 3)
+        shadow_offset = 2
+        
+        # Load font
+        font = self.load_font()
+        shadow_font = font
+        
         # Parse color codes
         segments = self.parse_color_codes(message_text)
         
         # Calculate text dimensions
-        temp_img = Image.new('RGB', (2000, 200), bg_color)
-        temp_draw = ImageDraw.Draw(temp_img)
-        
         x_offset = 0
         max_height = 0
+        widths = []
         for text, color in segments:
-            bbox = temp_draw.textbbox((0, 0), text, font=font)
+            bbox = font.getbbox(text)
             text_width = bbox[2] - bbox[0]
             text_height = bbox[3] - bbox[1]
+            widths.append(text_width)
             x_offset += text_width
             max_height = max(max_height, text_height)
         
@@ -263,28 +323,18 @@ class EarthMCMonitor:
         panel_height = total_text_height + panel_padding * 2
         
         # Try to load random background image
-        background_dir = Path('./tbi/data/backgrounds')
-        background_images = []
-        
-        if background_dir.exists():
-            for ext in ['*.png', '*.jpg', '*.jpeg', '*.PNG', '*.JPG', '*.JPEG']:
-                background_images.extend(background_dir.glob(ext))
+        background_images = self.load_backgrounds()
         
         background = None
         if background_images:
-            bg_path = random.choice(background_images)
-            try:
-                background = Image.open(bg_path).convert('RGBA')
-                logger.debug(f"Using background: {bg_path.name}")
-                
-                min_width = panel_width + buffer_pixels * 2
-                min_height = panel_height + buffer_pixels * 2
-                
-                if background.width < min_width or background.height < min_height:
-                    logger.warning(f"Background too small, need at least {min_width}x{min_height}")
-                    background = None
-            except Exception as e:
-                logger.warning(f"Failed to load background: {e}")
+            bg_name, background = random.choice(background_images)
+            logger.debug(f"Using background: {bg_name}")
+            
+            min_width = panel_width + buffer_pixels * 2
+            min_height = panel_height + buffer_pixels * 2
+            
+            if background.width < min_width or background.height < min_height:
+                logger.warning(f"Background too small, need at least {min_width}x{min_height}")
                 background = None
         
         # Create image and choose text position
@@ -301,7 +351,6 @@ class EarthMCMonitor:
             
             img = background.copy()
         else:
-            from PIL import ImageColor
             bg_rgba = ImageColor.getrgb(bg_color) + (255,)
             img = Image.new('RGBA', 
                           (panel_width + buffer_pixels * 2, panel_height + buffer_pixels * 2), 
@@ -309,33 +358,26 @@ class EarthMCMonitor:
             text_x = buffer_pixels
             text_y = buffer_pixels
         
-        # Draw semi-transparent panel
-        overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
-        overlay_draw = ImageDraw.Draw(overlay)
-        
-        panel_rect = [
-            text_x,
-            text_y,
-            text_x + panel_width,
-            text_y + panel_height
-        ]
-        overlay_draw.rectangle(panel_rect, fill=(*panel_color, text_bg_opacity))
-        
-        img = Image.alpha_composite(img, overlay)
+        # Blend the semi-transparent panel into its own region only
+        # (the rectangle is inclusive of its far edges, clipped to the image)
+        panel_size = (
+            min(panel_width + 1, img.width - text_x),
+            min(panel_height + 1, img.height - text_y)
+        )
+        panel = Image.new('RGBA', panel_size, (*panel_color, text_bg_opacity))
+        img.alpha_composite(panel, (text_x, text_y))
         
         # Draw text
         draw = ImageDraw.Draw(img)
         x_pos = text_x + panel_padding
         y_pos = text_y + panel_padding
         
-        for text, color in segments:
-            shadow_color = self.darken_color(color, factor=0.25)
+        for (text, color), text_width in zip(segments, widths):
+            shadow_color = self.config.shadow_colors.get(color) or self.darken_color(color, factor=0.25)
             draw.text((x_pos + shadow_offset, y_pos + shadow_offset), 
                      text, fill=shadow_color, font=shadow_font)
             draw.text((x_pos, y_pos), text, fill=color, font=font)
             
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = bbox[2] - bbox[0]
             x_pos += text_width
         
         # Crop to text area
@@ -350,10 +392,10 @@ class EarthMCMonitor:
         
         # Convert to bytes
         img_bytes = io.BytesIO()
-        img.save(img_bytes, format='PNG')
-        img_bytes.seek(0)
+        # Fast zlib level: the photo backgrounds barely shrink at higher levels
+        img.save(img_bytes, format='PNG', compress_level=1)
         
-        return img_bytes
+        return img_bytes.getvalue()
     
     async def send_notification(self, message_text, relay_groups, notif_type='town'):
         """Send notification to relay groups via webhooks"""
@@ -361,42 +403,63 @@ class EarthMCMonitor:
             logger.warning(f"No relay groups configured for {notif_type} notifications")
             return
         
-        image = self.generate_minecraft_image(message_text, notif_type)
+        # Rendered once (and cached by message text) off the event loop, wrapped per channel
+        image_bytes = await asyncio.to_thread(self.render_minecraft_png, message_text, notif_type)
+        
+        channel_ids = [
+            channel_id
+            for group_name in relay_groups
+            for channel_id in self.config.get_destination_channel_ids(group_name)
+        ]
         
-        for group_name in relay_groups:
-            dest_channel_ids = self.config.get_destination_channel_ids(group_name)
+        # Per-webhook pacing is handled by the rate limiter
+        await asyncio.gather(*(
+            self.send_to_channel(channel_id, image_bytes, notif_type)
+            for channel_id in channel_ids
+        ))
+    
+    async def send_to_channel(self, channel_id, image_bytes, notif_type):
+        """Send a notification image to a single destination channel"""
+        try:
+            channel = self.bot.get_channel(channel_id)
+            if not channel:
+                logger.warning(f"Channel {channel_id} not found")
+                return
             
-            for channel_id in dest_channel_ids:
-                try:
-                    channel = self.bot.get_channel(channel_id)
-                    if not channel:
-                        logger.warning(f"Channel {channel_id} not found")
-                        continue
-                    
-                    if not isinstance(channel, discord.TextChannel):
-                        logger.warning(f"Channel {channel_id} is not a text channel")
-                        continue
-                    
-                    webhook = await self.webhook_manager.get_webhook(channel)
-                    if not webhook:
-                        logger.error(f"Could not get webhook for {channel.name}")
-                        continue
-                    
-                    image.seek(0)
-                    file = discord.File(image, filename='image.png')
-                    
-                    await webhook.send(
-                        username="Project Pulitzer",
-                        file=file,
-                        wait=False
-                    )
-                    
-                    logger.info(f"Sent {notif_type} notification to {channel.name}")
-                    
-                except Exception as e:
-                    logger.error(f"Error sending notification to channel {channel_id}: {e}")
+            if not isinstance(channel, discord.TextChannel):
+                logger.warning(f"Channel {channel_id} is not a text channel")
+                return
+            
+            async with self.send_semaphore:
+                webhook = await self.webhook_manager.get_webhook(channel)
+                if not webhook:
+                    logger.error(f"Could not get webhook for {channel.name}")
+                    return
                 
-                await asyncio.sleep(0.5)
+                file = discord.File(io.BytesIO(image_bytes), filename='image.png')
+                
+                await self.webhook_manager.rate_limiter.acquire(webhook.id)
+                await webhook.send(
+                    username="Project Pulitzer",
+                    file=file,
+                    wait=False
+                )
+            
+            logger.info(f"Sent {notif_type} notification to {channel.name}")
+            
+        except (discord.NotFound, discord.Forbidden) as e:
+            self.webhook_manager.forget_webhook(channel, e)
+            logger.error(f"Error sending notification to channel {channel_id}: {e}")
+        except Exception as e:
+            logger.error(f"Error sending notification to channel {channel_id}: {e}")
+    
+    def extract_names(self, api_data, key):
+        """Reduce an API listing to a {uuid: name} dict"""
+        # Handle API response format
+        if isinstance(api_data, dict):
+            api_data = api_data.get(key, api_data.get('data', []))
+        
+        return {item['uuid']: item['name'] for item in api_data}
     
     async def _monitor_loop(self):
         """Main monitoring loop"""
@@ -415,20 +478,12 @@ class EarthMCMonitor:
                     await asyncio.sleep(poll_interval)
                     continue
                 
-                # Handle API response format
-                if isinstance(towns_data, dict):
-                    towns_list = towns_data.get('towns', towns_data.get('data', []))
-                else:
-                    towns_list = towns_data
-                    
-                if isinstance(nations_data, dict):
-                    nations_list = nations_data.get('nations', nations_data.get('data', []))
-                else:
-                    nations_list = nations_data
+                # Build current state, keeping only uuid -> name
+                current_towns = self.extract_names(towns_data, 'towns')
+                current_nations = self.extract_names(nations_data, 'nations')
                 
-                # Build current state
-                current_towns = {town['uuid']: town['name'] for town in towns_list}
-                current_nations = {nation['uuid']: nation['name'] for nation in nations_list}
+                # Release the full API payloads before sending notifications
+                towns_data = nations_data = None
                 
                 # Check for changes
                 if self.previous_towns:
@@ -437,10 +492,12 @@ class EarthMCMonitor:
                 if self.previous_nations:
                     await self._check_nation_changes(current_nations)
                 
-                # Update state
+                # Update state, writing it to disk only when something changed
+                changed = current_towns != self.previous_towns or current_nations != self.previous_nations
                 self.previous_towns = current_towns
                 self.previous_nations = current_nations
-                self.save_state()
+                if changed:
+                    await asyncio.to_thread(self.save_state)
                 
                 logger.info(f"Monitoring complete: {len(current_towns)} towns, {len(current_nations)} nations")
                 
@@ -454,74 +511,74 @@ class EarthMCMonitor:
     
     async def _check_town_changes(self, current_towns):
         """Check for town changes"""
-        templates = self.config.get_notification_templates('town')
+        templates = self.config.get_notification_template_fns('town')
         relay_groups = self.config.get_notification_relay_groups('town')
         
+        current_uuids = current_towns.keys()
+        previous_uuids = self.previous_towns.keys()
+        
         # New towns
-        new_town_uuids = set(current_towns.keys()) - set(self.previous_towns.keys())
-        for uuid in sorted(new_town_uuids):
+        new_town_uuids = current_uuids - previous_uuids
+        details_map = await self.fetch_towns_details(new_town_uuids) if new_town_uuids else {}
+        for uuid in new_town_uuids:
             town_name = current_towns[uuid]
-            details = await self.fetch_town_details(uuid)
+            details = details_map.get(uuid)
             leader = details.get('mayor', {}).get('name', 'Unknown') if details else 'Unknown'
             
-            message = templates['created'].format(name=town_name, leader=leader)
+            message = templates['created'](name=town_name, leader=leader)
             logger.info(f"New town: {town_name} (Mayor: {leader})")
             await self.send_notification(message, relay_groups, 'town')
-            await asyncio.sleep(0.5)
         
         # Removed towns
-        removed_town_uuids = set(self.previous_towns.keys()) - set(current_towns.keys())
-        for uuid in sorted(removed_town_uuids):
+        removed_town_uuids = previous_uuids - current_uuids
+        for uuid in removed_town_uuids:
             town_name = self.previous_towns[uuid]
-            message = templates['removed'].format(name=town_name)
+            message = templates['removed'](name=town_name)
             logger.info(f"Removed town: {town_name}")
             await self.send_notification(message, relay_groups, 'town')
-            await asyncio.sleep(0.5)
         
         # Renamed towns
-        for uuid in current_towns:
-            if uuid in self.previous_towns:
-                old_name = self.previous_towns[uuid]
-                new_name = current_towns[uuid]
-                if old_name != new_name:
-                    message = templates['renamed'].format(old_name=old_name, new_name=new_name)
-                    logger.info(f"Town renamed: {old_name} → {new_name}")
-                    await self.send_notification(message, relay_groups, 'town')
-                    await asyncio.sleep(0.5)
+        for uuid in current_uuids & previous_uuids:
+            old_name = self.previous_towns[uuid]
+            new_name = current_towns[uuid]
+            if old_name != new_name:
+                message = templates['renamed'](old_name=old_name, new_name=new_name)
+                logger.info(f"Town renamed: {old_name} → {new_name}")
+                await self.send_notification(message, relay_groups, 'town')
     
     async def _check_nation_changes(self, current_nations):
         """Check for nation changes"""
-        templates = self.config.get_notification_templates('nation')
+        templates = self.config.get_notification_template_fns('nation')
         relay_groups = self.config.get_notification_relay_groups('nation')
         
+        current_uuids = current_nations.keys()
+        previous_uuids = self.previous_nations.keys()
+        
         # New nations
-        new_nation_uuids = set(current_nations.keys()) - set(self.previous_nations.keys())
-        for uuid in sorted(new_nation_uuids):
+        new_nation_uuids = current_uuids - previous_uuids
+        details_map = await self.fetch_nations_details(new_nation_uuids) if new_nation_uuids else {}
+        for uuid in new_nation_uuids:
             nation_name = current_nations[uuid]
-            details = await self.fetch_nation_details(uuid)
+            details = details_map.get(uuid)
             leader = details.get('king', {}).get('name', 'Unknown') if details else 'Unknown'
             
-            message = templates['created'].format(name=nation_name, leader=leader)
+            message = templates['created'](name=nation_name, leader=leader)
             logger.info(f"New nation: {nation_name} (King: {leader})")
             await self.send_notification(message, relay_groups, 'nation')
-            await asyncio.sleep(0.5)
         
         # Removed nations
-        removed_nation_uuids = set(self.previous_nations.keys()) - set(current_nations.keys())
-        for uuid in sorted(removed_nation_uuids):
+        removed_nation_uuids = previous_uuids - current_uuids
+        for uuid in removed_nation_uuids:
             nation_name = self.previous_nations[uuid]
-            message = templates['removed'].format(name=nation_name)
+            message = templates['removed'](name=nation_name)
             logger.info(f"Removed nation: {nation_name}")
             await self.send_notification(message, relay_groups, 'nation')
-            await asyncio.sleep(0.5)
         
         # Renamed nations
-        for uuid in current_nations:
-            if uuid in self.previous_nations:
-                old_name = self.previous_nations[uuid]
-                new_name = current_nations[uuid]
-                if old_name != new_name:
-                    message = templates['renamed'].format(old_name=old_name, new_name=new_name)
-                    logger.info(f"Nation renamed: {old_name} → {new_name}")
-                    await self.send_notification(message, relay_groups, 'nation')
-                    await asyncio.sleep(0.5)
\ No newline at end of file
+        for uuid in current_uuids & previous_uuids:
+            old_name = self.previous_nations[uuid]
+            new_name = current_nations[uuid]
+            if old_name != new_name:
+                message = templates['renamed'](old_name=old_name, new_name=new_name)
+                logger.info(f"Nation renamed: {old_name} → {new_name}")
+                await self.send_notification(message, relay_groups, 'nation')
\ No newline at end of file
@@ -1,10 +1,24 @@
 import discord
 import logging
-from typing import Dict, Any, Tuple, List
-from utils import build_message_link, format_message_footer
+import asyncio
+import hashlib
+from typing import Dict, Any, Tuple, List, Set, Optional
+from utils import build_message_link, format_message_footer, build_avatar_url
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of messages waiting per relay group
+RELAY_QUEUE_SIZE = 1000
+
+# Maximum number of webhook sends in flight at once
+MAX_CONCURRENT_SENDS = 64
+
+# Discord message content limit
+MAX_CONTENT_LENGTH = 2000
+
+# Attachment file extensions shown as image embeds
+IMAGE_EXTENSIONS = frozenset(('png', 'jpg', 'jpeg', 'gif', 'webp'))
+
 class MessageHandler:
     """Handles processing and routing of relayed messages"""
     
@@ -12,79 +26,146 @@ class MessageHandler:
         self.config = config
         self.webhook_manager = webhook_manager
         self.bot = bot_client
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.workers: Dict[str, asyncio.Task] = {}
+        self.queued: Set[bytes] = set()
+        self.inflight: Dict[bytes, asyncio.Task] = {}
+        self.send_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+        self.destinations: Dict[str, Tuple[List[int], List[discord.TextChannel]]] = {}
+        self.failed_count = 0
+    
+    def message_key(self, message_data: Dict[str, Any]) -> Optional[bytes]:
+        """
+        Build a key identifying duplicate deliveries of the same message
+        Returns None without a message_id, as separate identical messages can't be told apart
+        """
+        if not message_data.get('message_id'):
+            return None
+        
+        key = (
+            (message_data.get('channel_id') or '')
+            + message_data['message_id']
+            + (message_data.get('content') or '')[:128]
+        )
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+    
+    @staticmethod
+    def normalize_ids(message_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert the message's IDs to strings once, as received JSON may carry numbers"""
+        for key in ('channel_id', 'message_id'):
+            # A null ID stays missing rather than becoming the string "None"
+            if message_data.get(key) is not None:
+                message_data[key] = str(message_data[key])
+        return message_data
+    
+    def enqueue_message(self, message_data: Dict[str, Any]) -> Tuple[bool, str]:
+        """
+        Queue a message for relaying by the background worker of its relay group
+        Returns: (queued, error_message)
+        Raises asyncio.QueueFull if the relay group's queue is full
+        """
+        channel_id = message_data.get('channel_id', '')
+        if not channel_id:
+            return False, "Missing channel_id"
+        
+        group_name = self.config.get_relay_group_for_channel(channel_id)
+        if not group_name:
+            logger.info("Channel %s not configured for relay", channel_id)
+            return False, "Channel not in any relay group"
+        
+        queue = self.queues.get(group_name)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=RELAY_QUEUE_SIZE)
+            self.queues[group_name] = queue
+            self.workers[group_name] = asyncio.create_task(self._queue_worker(group_name, queue))
+        
+        # Drop retries of a message that is already queued or being relayed
+        key = self.message_key(message_data)
+        if key is not None and (key in self.queued or key in self.inflight):
+            logger.info("Duplicate message from channel %s ignored", channel_id)
+            return True, ""
+        
+        queue.put_nowait(message_data)
+        if key is not None:
+            self.queued.add(key)
+        return True, ""
+    
+    async def _queue_worker(self, group_name: str, queue: asyncio.Queue):
+        """Relay queued messages for a relay group in arrival order"""
+        while True:
+            message_data = await queue.get()
+            self.queued.discard(self.message_key(message_data))
+            try:
+                success, error_msg = await self.process_message(message_data)
+                if not success:
+                    self.failed_count += 1
+                    logger.warning("Queued message for %s not relayed: %s", group_name, error_msg)
+            finally:
+                queue.task_done()
     
     async def process_message(self, message_data: Dict[str, Any]) -> Tuple[bool, str]:
         """
         Process incoming message and relay to destinations
+        Duplicate deliveries share the result of the relay already in flight
         Returns: (success, error_message)
         """
+        key = self.message_key(message_data)
+        if key is None:
+            return await self._relay_message(message_data)
+        
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._relay_message(message_data))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        
+        return await asyncio.shield(task)
+    
+    async def _relay_message(self, message_data: Dict[str, Any]) -> Tuple[bool, str]:
+        """Relay a message to all destinations of its relay group"""
         try:
             # Extract basic message info
-            channel_id = str(message_data.get('channel_id', ''))
-            message_id = str(message_data.get('message_id', ''))
+            channel_id = message_data.get('channel_id', '')
             
             if not channel_id:
                 logger.error("Message missing channel_id")
                 return False, "Missing channel_id"
             
-            # Find which relay group this channel belongs to
-            group_name = self.config.get_relay_group_for_channel(channel_id)
-            if not group_name:
-                logger.info(f"Channel {channel_id} not configured for relay")
+            # Find the relay group, source channel info and destinations in one lookup
+            route = self.config.get_channel_route(channel_id)
+            if not route:
+                logger.info("Channel %s not configured for relay", channel_id)
                 return False, "Channel not in any relay group"
             
-            logger.info(f"Processing message for relay group: {group_name}")
+            group_name, source_info, dest_channel_ids = route
+            logger.info("Processing message for relay group: %s", group_name)
             
-            # Get source channel info
-            source_info = self.config.get_source_channel_info(channel_id)
             if not source_info:
-                logger.warning(f"No source info found for channel {channel_id}")
+                logger.warning("No source info found for channel %s", channel_id)
                 source_info = {
                     "guild_id": "unknown",
                     "guild_name": "Unknown Server",
                     "channel_name": "unknown"
                 }
             
-            # Get destination channel IDs
-            dest_channel_ids = self.config.get_destination_channel_ids(group_name)
             if not dest_channel_ids:
-                logger.warning(f"No destinations configured for group {group_name}")
+                logger.warning("No destinations configured for group %s", group_name)
                 return False, "No destinations configured"
             
             # Build message components
             username, avatar_url = self.extract_author_info(message_data)
-            content = self.build_message_content(message_data, source_info)
-            embeds = self.build_embeds(message_data)
+            attachment_links, image_embeds = self.process_attachments(message_data)
+            content = self.build_message_content(message_data, source_info, attachment_links)
+            embeds = self.build_embeds(message_data, image_embeds)
             
-            # Send to all destination channels
-            success_count = 0
-            fail_count = 0
-            
-            for dest_channel_id in dest_channel_ids:
-                channel = self.bot.get_channel(dest_channel_id)
-                if not channel:
-                    logger.warning(f"Destination channel {dest_channel_id} not found or not accessible")
-                    fail_count += 1
-                    continue
-                
-                if not isinstance(channel, discord.TextChannel):
-                    logger.warning(f"Channel {dest_channel_id} is not a text channel")
-                    fail_count += 1
-                    continue
-                
-                try:
-                    success = await self.webhook_manager.send_webhook_message(
-                        channel, username, avatar_url, content, embeds
-                    )
-                    
-                    if success:
-                        success_count += 1
-                    else:
-                        fail_count += 1
-                        
-                except Exception as e:
-                    logger.error(f"Failed to send to channel {channel.name}: {e}")
-                    fail_count += 1
+            # Send to all destination channels concurrently
+            channels = self.resolve_destinations(group_name, dest_channel_ids)
+            results = await asyncio.gather(*(
+                self._send_to_destination(channel, username, avatar_url, content, embeds)
+                for channel in channels
+            ))
+            success_count = sum(results)
+            fail_count = len(dest_channel_ids) - success_count
             
             # Return result
             if success_count > 0:
@@ -95,9 +176,53 @@ class MessageHandler:
                 return False, f"Failed to send to all {fail_count} destinations"
                 
         except Exception as e:
-            logger.error(f"Error in process_message: {e}", exc_info=True)
+            logger.error("Error in process_message: %s", e, exc_info=True)
             return False, str(e)
     
+    def resolve_destinations(self, group_name: str,
+                             dest_channel_ids: List[int]) -> List[discord.TextChannel]:
+        """
+        Resolve a relay group's destination IDs to text channels
+        Cached until the config provides a new ID list, unless some channels were missing
+        """
+        cached = self.destinations.get(group_name)
+        if cached is not None and cached[0] is dest_channel_ids:
+            return cached[1]
+        
+        channels = []
+        missing = False
+        for dest_channel_id in dest_channel_ids:
+            channel = self.bot.get_channel(dest_channel_id)
+            if not channel:
+                logger.warning("Destination channel %s not found or not accessible", dest_channel_id)
+                missing = True
+                continue
+            
+            # Other channel types can't be relayed to; reported once, when resolved
+            if not isinstance(channel, discord.TextChannel):
+                logger.warning("Channel %s is not a text channel", dest_channel_id)
+                continue
+            
+            channels.append(channel)
+        
+        # Keep resolving on every message until all channels are visible to the bot
+        if not missing:
+            self.destinations[group_name] = (dest_channel_ids, channels)
+        
+        return channels
+    
+    async def _send_to_destination(self, channel: discord.TextChannel, username: str, avatar_url: str,
+                                   content: str, embeds: List[discord.Embed]) -> bool:
+        """Send a relayed message to one destination channel"""
+        try:
+            async with self.send_semaphore:
+                return await self.webhook_manager.send_webhook_message(
+                    channel, username, avatar_url, content, embeds
+                )
+        except Exception as e:
+            logger.error("Failed to send to channel %s: %s", channel.name, e)
+            return False
+    
     def extract_author_info(self, message_data: Dict[str, Any]) -> Tuple[str, str]:
         """Extract username and avatar URL from message data"""
         author = message_data.get('author', {})
@@ -110,14 +235,45 @@ class MessageHandler:
             user_id = author.get('id')
             if user_id:
                 # Discord CDN avatar URL
-                avatar_url = f"https://cdn.discordapp.com/avatars/{user_id}/{avatar}.png"
+                avatar_url = build_avatar_url(user_id, avatar)
         
         return username, avatar_url
     
+    def process_attachments(self, message_data: Dict[str, Any]) -> Tuple[List[str], List[discord.Embed]]:
+        """
+        Turn the first 10 attachments into markdown links and image embeds in one pass
+        Returns: (attachment_links, image_embeds)
+        """
+        attachment_links = []
+        image_embeds = []
+        
+        attachments = message_data.get('attachments', [])
+        if not attachments or not isinstance(attachments, list):
+            return attachment_links, image_embeds
+        
+        for att in attachments[:10]:
+            url = att.get('url') or att.get('proxy_url')
+            if not url:
+                continue
+            
+            attachment_links.append(f"[{att.get('filename', 'file')}]({url})")
+            
+            # Check if it's an image (ignoring any query string)
+            ext = url.split('?', 1)[0].rsplit('.', 1)[-1].lower()
+            if ext in IMAGE_EXTENSIONS:
+                embed = discord.Embed()
+                embed.set_image(url=url)
+                image_embeds.append(embed)
+        
+        return attachment_links, image_embeds
+    
     def build_message_content(self, message_data: Dict[str, Any], 
-                             source_info: Dict[str, Any]) -> str:
+                             source_info: Dict[str, Any],
+                             attachment_links: List[str]) -> str:
         """Build the message content with footer"""
-        content = message_data.get('content', '')
+        # Anything past the limit is cut below anyway; one extra character keeps the
+        # truncation decision the same without copying an oversized message around
+        content = (message_data.get('content') or '')[:MAX_CONTENT_LENGTH + 1]
         
         # Build message link
         message_link = build_message_link(
@@ -133,34 +289,27 @@ class MessageHandler:
             message_link
         )
         
-        # Append footer to content
-        full_content = content
-        if footer:
-            if full_content:
-                full_content += f"\n{footer}"
-            else:
-                full_content = footer
+        parts = []
+        if content:
+            # Blank line between the message and its footer
+            parts.append(content)
+            parts.append("")
+        parts.append(footer)
         
         # ADD ATTACHMENTS BELOW FOOTER as single-line compact list
-        attachments = message_data.get('attachments', [])
-        if attachments:
-            attachment_links = []
-            for att in attachments[:10]:
-                url = att.get('url') or att.get('proxy_url')
-                filename = att.get('filename', 'file')
-                if url:
-                    attachment_links.append(f"[{filename}]({url})")
-            
-            if attachment_links:
-                full_content += f"\n-# {', '.join(attachment_links)}"
+        if attachment_links:
+            parts.append(f"-# {', '.join(attachment_links)}")
+        
+        full_content = "\n".join(parts)
         
         # Limit content length (Discord limit is 2000 characters)
-        if len(full_content) > 2000:
-            full_content = full_content[:1997] + "..."
+        if len(full_content) > MAX_CONTENT_LENGTH:
+            full_content = full_content[:MAX_CONTENT_LENGTH - 3] + "..."
         
         return full_content
     
-    def build_embeds(self, message_data: Dict[str, Any]) -> List[discord.Embed]:
+    def build_embeds(self, message_data: Dict[str, Any],
+                     image_embeds: List[discord.Embed]) -> List[discord.Embed]:
         """Build embeds from message data"""
         embeds = []
         
@@ -173,24 +322,9 @@ class MessageHandler:
                     embed = discord.Embed.from_dict(embed_data)
                     embeds.append(embed)
                 except Exception as e:
-                    logger.warning(f"Failed to parse embed: {e}")
+                    logger.warning("Failed to parse embed: %s", e)
         
-        # Handle attachments as embeds
-        attachments = message_data.get('attachments', [])
-        if attachments and isinstance(attachments, list):
-            for att in attachments[:10]:  # Limit total embeds
-                if len(embeds) >= 10:
-                    break
-                
-                url = att.get('url') or att.get('proxy_url')
-                if not url:
-                    continue
-                
-                # Check if it's an image
-                if any(url.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']):
-                    embed = discord.Embed()
-                    embed.set_image(url=url)
-                    embeds.append(embed)
+        # Add image attachments as embeds, up to the limit of 10 in total
+        embeds.extend(image_embeds[:10 - len(embeds)])
         
-        # Return list or None (webhook_manager will handle None properly)
-        return embeds if embeds else None
\ No newline at end of file
+        return embeds
\ No newline at end of file
@@ -0,0 +1,35 @@
+"""
+Rate limiting for outbound webhook requests
+Paces sends per webhook so Discord never has to answer with a 429
+"""
+
+import asyncio
+import time
+from typing import Dict, Hashable, Tuple
+
+class RateLimiter:
+    """Token bucket rate limiter with one bucket per key"""
+    
+    def __init__(self, rate: float = 2.5, burst: int = 5):
+        # Discord allows 5 requests per 2 seconds on a single webhook
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[Hashable, Tuple[float, float]] = {}
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self, key: Hashable):
+        """Wait until a token is available in the bucket for key"""
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                tokens, last = self.buckets.get(key, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                
+                if tokens >= 1:
+                    self.buckets[key] = (tokens - 1, now)
+                    return
+                
+                self.buckets[key] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            
+            await asyncio.sleep(wait)
@@ -2,26 +2,42 @@
 Utility functions for the relay bot
 """
 
+import re
+import string
+import functools
+from typing import Callable
+
+# Characters and words Discord does not allow in webhook usernames
+USERNAME_FORBIDDEN_CHARS = str.maketrans('', '', '@#:')
+USERNAME_FORBIDDEN_RE = re.compile(r'```|discord', re.IGNORECASE)
+
 def build_message_link(guild_id: str, channel_id: str, message_id: str) -> str:
     """
     Build a Discord message jump link
     Format: https://discord.com/channels/{guild_id}/{channel_id}/{message_id}
     """
-    if not all([guild_id, channel_id, message_id]):
+    if not (guild_id and channel_id and message_id):
         return ""
     
     return f"https://discord.com/channels/{guild_id}/{channel_id}/{message_id}"
 
+@functools.lru_cache(maxsize=4096)
+def build_avatar_url(user_id: str, avatar: str) -> str:
+    """Build a Discord CDN avatar URL (cached, chatty users repeat constantly)"""
+    return f"https://cdn.discordapp.com/avatars/{user_id}/{avatar}.png"
+
+@functools.lru_cache(maxsize=1024)
+def format_message_origin(guild_name: str, channel_name: str) -> str:
+    """Format the origin line of the footer (cached per source channel)"""
+    return f"-# 📍 **{guild_name}** | #{channel_name}"
+
 def format_message_footer(guild_name: str, channel_name: str, message_link: str = None) -> str:
     """
     Format the footer that appears at the end of relayed messages
     Shows origin server/channel and jump link if available
     """
-    footer_parts = [""]
-    
     # Add origin info
-    origin = f"-# 📍 **{guild_name}** | #{channel_name}"
-    footer_parts.append(origin)
+    footer_parts = [format_message_origin(guild_name, channel_name)]
     
     # Add jump link if available
     if message_link:
@@ -29,6 +45,42 @@ def format_message_footer(guild_name: str, channel_name: str, message_link: str
     
     return "\n".join(footer_parts)
 
+def darken_color(hex_color: str, factor: float = 0.25) -> str:
+    """Darken a hex color by a given factor"""
+    hex_color = hex_color.lstrip('#')
+    r = int(hex_color[0:2], 16)
+    g = int(hex_color[2:4], 16)
+    b = int(hex_color[4:6], 16)
+    
+    r = int(r * factor)
+    g = int(g * factor)
+    b = int(b * factor)
+    
+    return f'#{r:02x}{g:02x}{b:02x}'
+
+def compile_template(template: str) -> Callable[..., str]:
+    """
+    Parse a str.format template once and return a function that fills it
+    Templates using conversions, format specs or positional fields fall back to str.format
+    """
+    parts = []
+    try:
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+            if field_name is not None and (format_spec or conversion or not field_name.isidentifier()):
+                return template.format
+            parts.append((literal, field_name))
+    except ValueError:
+        # Malformed template, let str.format report it when used
+        return template.format
+    
+    def render(**fields) -> str:
+        return "".join(
+            literal if field_name is None else literal + str(fields[field_name])
+            for literal, field_name in parts
+        )
+    
+    return render
+
 def truncate_text(text: str, max_length: int, suffix: str = "...") -> str:
     """Truncate text to maximum length"""
     if not text or len(text) <= max_length:
@@ -44,25 +96,12 @@ def sanitize_webhook_username(username: str) -> str:
     if not username:
         return "Unknown User"
     
-    # Remove or replace forbidden characters
-    forbidden = ['@', '#', ':', '```', 'discord']
-    sanitized = username
-    
-    for forbidden_str in forbidden:
-        sanitized = sanitized.replace(forbidden_str, '')
-    
-    # Trim whitespace
-    sanitized = sanitized.strip()
-    
-    # Ensure it's not empty after sanitization
-    if not sanitized:
-        return "Unknown User"
+    # Remove forbidden characters, then forbidden words, and trim whitespace
+    sanitized = USERNAME_FORBIDDEN_RE.sub('', username.translate(USERNAME_FORBIDDEN_CHARS)).strip()
     
     # Limit length (Discord limit is 80 characters for webhook usernames)
-    if len(sanitized) > 80:
-        sanitized = sanitized[:80]
-    
-    return sanitized
+    # and ensure it's not empty after sanitization
+    return sanitized[:80] or "Unknown User"
 
 def format_attachment_text(attachments: list) -> str:
     """Format attachment list as text"""
@@ -82,16 +121,8 @@ def format_attachment_text(attachments: list) -> str:
 
 def validate_discord_id(id_str: str) -> bool:
     """Validate that a string is a valid Discord snowflake ID"""
-    if not id_str:
-        return False
-    
-    try:
-        # Discord IDs are numeric strings
-        int(id_str)
-        # Discord IDs are typically 17-19 characters
-        return 17 <= len(id_str) <= 19
-    except ValueError:
-        return False
+    # Discord IDs are numeric strings, typically 17-19 characters
+    return bool(id_str) and 17 <= len(id_str) <= 19 and id_str.isascii() and id_str.isdigit()
 
 def parse_author_info(author_data: dict) -> dict:
     """Parse and validate author information from message data"""
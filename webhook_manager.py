@@ -1,42 +1,38 @@
 import discord
 import logging
-from typing import Dict, Optional
+from collections import OrderedDict
+from discord.utils import MISSING
+from typing import List, Optional
+from rate_limiter import RateLimiter
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of channel webhooks kept cached (least recently used are dropped)
+WEBHOOK_CACHE_SIZE = 1024
+
 class WebhookManager:
     """Manages Discord webhooks for relaying messages"""
     
     def __init__(self, bot, webhook_name: str = "Relay Bot"):
         self.bot = bot
         self.webhook_name = webhook_name
-        self.webhooks: Dict[int, discord.Webhook] = {}
+        self.webhooks: OrderedDict[int, discord.Webhook] = OrderedDict()
+        self.rate_limiter = RateLimiter()
     
     async def get_webhook(self, channel: discord.TextChannel) -> Optional[discord.Webhook]:
         """Get or create a webhook for a channel"""
         channel_id = channel.id
         
         # Check if we already have a webhook cached
-        if channel_id in self.webhooks:
-            try:
-                # Test if webhook is still valid
-                webhook = self.webhooks[channel_id]
-                await webhook.fetch()
-                # Make sure the webhook has a token
-                if not webhook.token:
-                    logger.warning(f"Cached webhook for {channel.name} has no token, removing from cache")
-                    del self.webhooks[channel_id]
-                else:
-                    return webhook
-            except discord.NotFound:
-                logger.info(f"Cached webhook for {channel.name} was deleted, removing from cache")
-                del self.webhooks[channel_id]
-            except discord.Forbidden:
-                logger.warning(f"Lost access to cached webhook for {channel.name}, removing from cache")
-                del self.webhooks[channel_id]
-            except Exception as e:
-                logger.warning(f"Webhook error for {channel.name}: {e}, removing from cache")
-                del self.webhooks[channel_id]
+        # (it is not re-validated here; a failed send removes it from the cache)
+        webhook = self.webhooks.get(channel_id)
+        if webhook is not None:
+            # Make sure the webhook has a token
+            if webhook.token:
+                self.webhooks.move_to_end(channel_id)
+                return webhook
+            logger.warning("Cached webhook for %s has no token, removing from cache", channel.name)
+            del self.webhooks[channel_id]
         
         try:
             # Look for existing webhooks in the channel
@@ -45,25 +41,18 @@ class WebhookManager:
             
             for webhook in webhooks:
                 if webhook.name == self.webhook_name:
-                    # Check if this webhook has a token and is accessible
+                    # The listing already includes the token for webhooks this bot created,
+                    # so no separate fetch is needed to check it
+                    if webhook.token:
+                        relay_webhook = webhook
+                        logger.info("Found existing valid webhook for channel %s", channel.name)
+                        break
+                    
+                    logger.info("Found webhook for %s but it has no token, will delete and recreate", channel.name)
                     try:
-                        await webhook.fetch()
-                        if webhook.token:
-                            relay_webhook = webhook
-                            logger.info(f"Found existing valid webhook for channel {channel.name}")
-                            break
-                        else:
-                            logger.info(f"Found webhook for {channel.name} but it has no token, will delete and recreate")
-                            try:
-                                await webhook.delete(reason="Webhook has no token, recreating")
-                            except:
-                                pass
-                    except Exception as webhook_error:
-                        logger.info(f"Found webhook for {channel.name} but it's invalid: {webhook_error}")
-                        try:
-                            await webhook.delete(reason="Invalid webhook, recreating")
-                        except:
-                            pass
+                        await webhook.delete(reason="Webhook has no token, recreating")
+                    except:
+                        pass
             
             # Create new webhook if none exists or existing one was invalid
             if not relay_webhook:
@@ -71,56 +60,60 @@ class WebhookManager:
                     name=self.webhook_name,
                     reason="Created for message relaying"
                 )
-                logger.info(f"Created new webhook for channel {channel.name}")
+                logger.info("Created new webhook for channel %s", channel.name)
             
             # Cache the valid webhook
             self.webhooks[channel_id] = relay_webhook
+            if len(self.webhooks) > WEBHOOK_CACHE_SIZE:
+                self.webhooks.popitem(last=False)
             return relay_webhook
             
         except discord.Forbidden:
-            logger.error(f"No permission to manage webhooks in {channel.name}")
+            logger.error("No permission to manage webhooks in %s", channel.name)
             return None
         except Exception as e:
-            logger.error(f"Error managing webhook for {channel.name}: {e}")
+            logger.error("Error managing webhook for %s: %s", channel.name, e)
             return None
     
+    def forget_webhook(self, channel: discord.TextChannel, error: Exception):
+        """Drop a cached webhook that Discord rejected so the next use recreates it"""
+        if self.webhooks.pop(channel.id, None) is not None:
+            logger.info("Cached webhook for %s is no longer usable (%s), removing from cache", channel.name, error)
+    
     async def send_webhook_message(self, channel: discord.TextChannel, 
                                    username: str, avatar_url: str, 
-                                   content: str, embeds: list = None) -> bool:
+                                   content: str, embeds: List[discord.Embed]) -> bool:
         """Send a message via webhook"""
         try:
-            webhook = await self.get_webhook(channel)
-            if not webhook:
-                logger.error(f"Could not get webhook for {channel.name}")
-                return False
-            
-            # Don't send empty content unless there are embeds
-            content_to_send = content if content or embeds else None
-            
-            # Build kwargs for webhook.send
-            send_kwargs = {
-                'username': username,
-                'wait': False
-            }
-            
-            if content_to_send:
-                send_kwargs['content'] = content_to_send
-            
-            if avatar_url:
-                send_kwargs['avatar_url'] = avatar_url
-            
-            # Only include embeds if there are any
-            if embeds:
-                send_kwargs['embeds'] = embeds
-            
-            await webhook.send(**send_kwargs)
+            # Retry once with a fresh webhook if the cached one was deleted or revoked
+            for attempt in range(2):
+                webhook = await self.get_webhook(channel)
+                if not webhook:
+                    logger.error("Could not get webhook for %s", channel.name)
+                    return False
+                
+                try:
+                    await self.rate_limiter.acquire(webhook.id)
+                    # Empty fields are left out of the request
+                    await webhook.send(
+                        content=content or MISSING,
+                        username=username,
+                        avatar_url=avatar_url or MISSING,
+                        embeds=embeds or MISSING,
+                        wait=False
+                    )
+                    break
+                except (discord.NotFound, discord.Forbidden) as e:
+                    self.forget_webhook(channel, e)
+                    if attempt:
+                        raise
             
-            logger.info(f"Successfully sent webhook message to {channel.name}")
+            logger.info("Successfully sent webhook message to %s", channel.name)
             return True
             
         except discord.HTTPException as e:
-            logger.error(f"HTTP error sending webhook to {channel.name}: {e}")
+            logger.error("HTTP error sending webhook to %s: %s", channel.name, e)
             return False
         except Exception as e:
-            logger.error(f"Unexpected error sending webhook to {channel.name}: {e}")
+            logger.error("Unexpected error sending webhook to %s: %s", channel.name, e)
             return False
\ No newline at end of file